@@ -1,4 +1,5 @@
-import sqlite3, pathlib, datetime, json
+import sqlite3, pathlib, json, contextvars, threading, functools, itertools
+from contextlib import contextmanager
 DB_PATH = pathlib.Path("eod.db")
 
 SCHEMA = """
@@ -28,45 +29,166 @@ CREATE TABLE IF NOT EXISTS job_rows (
   at_risk INTEGER,
   FOREIGN KEY(snapshot_id) REFERENCES snapshots(id)
 );
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_job_rows_snapshot_name ON job_rows(snapshot_id, job_name);
+CREATE INDEX IF NOT EXISTS ix_snapshots_date ON snapshots(snapshot_date DESC, id DESC);
+PRAGMA optimize;
 """
 
-def get_conn():
-  conn = sqlite3.connect(DB_PATH)
-  conn.row_factory = sqlite3.Row
+# Connection shared by every helper inside a db_session() block.
+_CONN: contextvars.ContextVar = contextvars.ContextVar("eod_db_conn", default=None)
+
+def get_conn(row_factory=sqlite3.Row):
+  """row_factory=sqlite3.Row for view-layer reads; pass None for plain tuples."""
+  # Autocommit: the sqlite3 module never opens transactions on its own; writes go through tx().
+  conn = sqlite3.connect(DB_PATH, isolation_level=None)
+  conn.row_factory = row_factory
+  conn.execute("PRAGMA synchronous=NORMAL")
+  conn.execute("PRAGMA temp_store=MEMORY")
+  conn.execute("PRAGMA mmap_size=268435456")
+  conn.execute("PRAGMA cache_size=-65536")
+  conn.execute("PRAGMA wal_autocheckpoint=1000")
+  return conn
+
+@contextmanager
+def db_session():
+  """Open one connection and reuse it for every helper called inside the block."""
+  conn = _CONN.get()
+  if conn is not None:
+    yield conn
+    return
+  conn = get_conn()
+  token = _CONN.set(conn)
+  try:
+    yield conn
+  finally:
+    _CONN.reset(token)
+    conn.close()
+
+# Outside a db_session(), each thread keeps one handle instead of reconnecting (and
+# re-running the PRAGMAs) on every helper call. Reads and tx() writes share it, so a
+# read inside tx() sees the rows written so far; the handle closes with its thread.
+_TLS = threading.local()
+
+def _thread_conn():
+  path = str(DB_PATH)
+  conn = getattr(_TLS, "conn", None)
+  if conn is not None and _TLS.path != path:
+    conn.close()
+    conn = None
+  if conn is None:
+    conn = _TLS.conn = get_conn()
+    _TLS.path = path
   return conn
 
-def init_db():
-  with get_conn() as c:
+def _conn(conn=None):
+  return conn or _CONN.get() or _thread_conn()
+
+def _cursor(conn=None, row_factory=sqlite3.Row):
+  # The row factory is picked per cursor, so one handle serves Row and tuple reads.
+  cur = _conn(conn).cursor()
+  cur.row_factory = row_factory
+  return cur
+
+@contextmanager
+def tx(conn=None):
+  """
+  One BEGIN IMMEDIATE ... COMMIT around the block (ROLLBACK if it raises), so a
+  snapshot, its rows and any meta updates cost a single commit. Inside an open
+  transaction it just joins it.
+  """
+  c = _conn(conn)
+  if c.in_transaction:
+    yield c
+    return
+  c.execute("BEGIN IMMEDIATE")
+  try:
+    yield c
+  except BaseException:
+    c.execute("ROLLBACK")
+    raise
+  c.execute("COMMIT")
+
+_INITIALIZED = set()  # DB paths whose schema has already been applied by this process
+
+def init_db(conn=None):
+  if str(DB_PATH) in _INITIALIZED:
+    return
+  with _conn(conn) as c:
     c.executescript(SCHEMA)
+  _INITIALIZED.add(str(DB_PATH))
+
+def _insert_snapshot(c, date_str: str):
+  # created_at is stamped by SQLite (UTC) rather than formatted in Python.
+  return c.execute("INSERT INTO snapshots (snapshot_date, created_at) VALUES (?, STRFTIME('%Y-%m-%dT%H:%M:%SZ','now'))",
+                   (date_str,)).lastrowid
+
+def create_snapshot(date_str: str, conn=None):
+  with tx(conn) as c:
+    return _insert_snapshot(c, date_str)
+
+JOB_ROW_KEYS = ["snapshot_id","job_code","job_name","pm","hours_today","labour_cost_today","materials_cost_today",
+                "cost_today","actual_cost_to_date","estimated_cost","burn_pct","gm_to_date","invoiced_today","mtd_hours",
+                "days_since_update","at_risk"]
+MAX_ROWS_PER_INSERT = 500  # keeps each statement's SQL text and parameter list small
+
+@functools.lru_cache(maxsize=8)
+def _insert_job_rows_sql(n: int) -> str:
+  one = f"({', '.join(['?']*len(JOB_ROW_KEYS))})"
+  return f"INSERT INTO job_rows ({', '.join(JOB_ROW_KEYS)}) VALUES {', '.join([one]*n)}"
+
+def _rows_per_insert(c) -> int:
+  try:
+    limit = c.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+  except AttributeError:  # Python < 3.11; 999 is SQLite's oldest default
+    limit = 999
+  return max(1, min(MAX_ROWS_PER_INSERT, limit // len(JOB_ROW_KEYS)))
+
+def _insert_job_rows(c, snapshot_id: int, rows: list[dict]):
+  # Multi-row VALUES: one bind/step per chunk instead of one per row.
+  vals = ((snapshot_id,
+           r.get("job_code"), r.get("job_name"), r.get("pm"),
+           r.get("hours_today",0), r.get("labour_cost_today",0), r.get("materials_cost_today",0),
+           r.get("cost_today",0), r.get("actual_cost_to_date",0), r.get("estimated_cost",0),
+           r.get("burn_pct"), r.get("gm_to_date"), r.get("invoiced_today",0), r.get("mtd_hours",0),
+           r.get("days_since_update",0), int(bool(r.get("at_risk", False))))
+          for r in rows)
+  per = _rows_per_insert(c)
+  while True:
+    chunk = list(itertools.islice(vals, per))
+    if not chunk:
+      break
+    c.execute(_insert_job_rows_sql(len(chunk)), [v for row in chunk for v in row])
+
+def insert_job_rows(snapshot_id: int, rows: list[dict], conn=None):
+  # One prepared statement + one transaction for the whole snapshot.
+  with tx(conn) as c:
+    _insert_job_rows(c, snapshot_id, rows)
+
+def save_snapshot(date_str: str, rows: list[dict], conn=None):
+  """Create a snapshot and all of its job rows in a single transaction; returns the snapshot id."""
+  with tx(conn) as c:
+    snapshot_id = _insert_snapshot(c, date_str)
+    _insert_job_rows(c, snapshot_id, rows)
+    return snapshot_id
+
+def get_meta(key: str, default=None, conn=None):
+  row = _cursor(conn, row_factory=None).execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+  return row[0] if row else default
+
+def set_meta(key: str, value, conn=None):
+  with tx(conn) as c:
+    c.execute("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+              (key, value))
+
+def list_snapshots(conn=None):
+  return _cursor(conn).execute("SELECT * FROM snapshots ORDER BY snapshot_date DESC, id DESC").fetchall()
+
+def get_snapshot_rows(snapshot_id: int, conn=None):
+  return _cursor(conn).execute("SELECT * FROM job_rows WHERE snapshot_id=? ORDER BY job_name", (snapshot_id,)).fetchall()
 
-def create_snapshot(date_str: str):
-  now = datetime.datetime.utcnow().isoformat()
-  with get_conn() as c:
-    cur = c.execute("INSERT INTO snapshots (snapshot_date, created_at) VALUES (?, ?)", (date_str, now))
-    return cur.lastrowid
-
-def insert_job_rows(snapshot_id: int, rows: list[dict]):
-  keys = ["snapshot_id","job_code","job_name","pm","hours_today","labour_cost_today","materials_cost_today",
-          "cost_today","actual_cost_to_date","estimated_cost","burn_pct","gm_to_date","invoiced_today","mtd_hours",
-          "days_since_update","at_risk"]
-  with get_conn() as c:
-    for r in rows:
-      vals = [snapshot_id,
-              r.get("job_code"), r.get("job_name"), r.get("pm"),
-              r.get("hours_today",0), r.get("labour_cost_today",0), r.get("materials_cost_today",0),
-              r.get("cost_today",0), r.get("actual_cost_to_date",0), r.get("estimated_cost",0),
-              r.get("burn_pct"), r.get("gm_to_date"), r.get("invoiced_today",0), r.get("mtd_hours",0),
-              r.get("days_since_update",0), int(bool(r.get("at_risk", False)))]
-      c.execute(f"INSERT INTO job_rows ({', '.join(keys)}) VALUES ({', '.join(['?']*len(keys))})", vals)
-
-def list_snapshots():
-  with get_conn() as c:
-    return c.execute("SELECT * FROM snapshots ORDER BY snapshot_date DESC, id DESC").fetchall()
-
-def get_snapshot_rows(snapshot_id: int):
-  with get_conn() as c:
-    return c.execute("SELECT * FROM job_rows WHERE snapshot_id=? ORDER BY job_name", (snapshot_id,)).fetchall()
-
-def get_latest_snapshot():
-  snaps = list_snapshots()
-  return snaps[0] if snaps else None
+def get_latest_snapshot(conn=None):
+  return _cursor(conn).execute("SELECT * FROM snapshots ORDER BY snapshot_date DESC, id DESC LIMIT 1").fetchone()
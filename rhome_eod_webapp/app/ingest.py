@@ -1,18 +1,39 @@
 # rhome_eod_webapp/app/ingest.py
-# Drop-in ingest that uses only the Python standard library (no httpx).
+# Drop-in ingest that needs only the Python standard library (no httpx); urllib3 is used for
+# connection pooling when it is installed (it ships with requests).
 # It fetches a token, then probes likely Simpro API paths and returns a clear JSON result,
 # never raising to FastAPI (so you don't get a 500 if something's off).
 
+import functools
+import gzip
+import hashlib
 import json
 import logging
 import os
+import random
 import time
 import urllib.error
 import urllib.parse
 import urllib.request
 import ssl
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Dict, List, Optional, Tuple
 
+from . import db
+
+try:
+    # Keep-alive pool for every Simpro call; plain urllib (one TLS handshake per request) is the fallback
+    import urllib3
+except ImportError:  # pragma: no cover
+    urllib3 = None
+
+try:
+    # orjson takes the raw bytes (no decode step) and is much faster; stdlib is the fallback
+    from orjson import loads as _loads
+except ImportError:  # pragma: no cover
+    from json import loads as _loads
+
 log = logging.getLogger("ingest")
 
 # ---- Config from environment ----
@@ -23,8 +44,50 @@ SCOPE = os.getenv("SIMPRO_SCOPE", "").strip()  # often not required
 API_BASE = os.getenv("SIMPRO_API_BASE", "").strip()  # e.g. "/api/v1.0"
 TIMEOUT = float(os.getenv("SIMPRO_TIMEOUT", "8"))
 VERIFY_TLS = os.getenv("SIMPRO_VERIFY_TLS", "true").lower() != "false"  # allow disabling in emergencies
+# Derived once; TENANT never changes for the life of the process.
+BASE_URL = f"https://{TENANT}.simprosuite.com"
+TOKEN_URL = f"{BASE_URL}/oauth2/token"
+PROBE_WORKERS = int(os.getenv("SIMPRO_PROBE_WORKERS", "8"))
+DISCOVERY_TTL = float(os.getenv("SIMPRO_DISCOVERY_TTL", "86400"))  # seconds to trust a discovered endpoint
+RETRY_ATTEMPTS = int(os.getenv("SIMPRO_RETRY_ATTEMPTS", "3"))
+RETRY_STATUSES = (0, 429, 500, 502, 503, 504)  # 0 = transport error (timeout, reset, DNS)
+RETRY_AFTER_MAX = 10.0  # seconds; a longer 429 Retry-After gives up rather than stall the ingest
+# Opt-in: file (outside the repo) where the OAuth token is kept across restarts. Unset = memory only.
+TOKEN_CACHE_PATH = os.getenv("SIMPRO_TOKEN_CACHE", "").strip()
 
 # ---- Simple HTTP helper (urllib) ----
+# Built once: create_default_context() loads the CA bundle, which is far too slow per request.
+_SSL_CTX = ssl.create_default_context()
+if not VERIFY_TLS:
+    _SSL_CTX.check_hostname = False
+    _SSL_CTX.verify_mode = ssl.CERT_NONE
+
+# Probes and the token call all hit one host; keep enough sockets open for every probe worker.
+# Retries are ours (_request_with_retry), so urllib3's own are off, but redirects are still
+# followed (up to 5) like urlopen does; a redirect loop returns its last 3xx.
+_POOL = None
+_NO_RETRY = None
+if urllib3 is not None:
+    _NO_RETRY = urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=5,
+                              raise_on_redirect=False, raise_on_status=False)
+    _POOL = urllib3.PoolManager(
+        num_pools=4,
+        maxsize=max(PROBE_WORKERS, 4),
+        block=False,
+        retries=_NO_RETRY,
+        ssl_context=_SSL_CTX,
+        **({} if VERIFY_TLS else {"cert_reqs": "CERT_NONE", "assert_hostname": False}),
+    )
+
+def _inflate(headers, body: bytes) -> bytes:
+    # urllib doesn't undo Content-Encoding for us.
+    if body and (headers.get("Content-Encoding") or "").lower() == "gzip":
+        try:
+            return gzip.decompress(body)
+        except OSError:
+            return body
+    return body
+
 def _http(
     method: str,
     url: str,
@@ -32,30 +95,157 @@ def _http(
     data: Optional[bytes] = None,
     timeout: float = TIMEOUT,
 ) -> Tuple[int, Dict[str, str], bytes, Optional[BaseException]]:
+    if _POOL is not None:
+        return _pooled_http(method, url, headers, data, timeout)
     req = urllib.request.Request(url, data=data, headers=headers or {}, method=method)
-    ctx = ssl.create_default_context()
-    if not VERIFY_TLS:
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
+    req.add_header("Accept-Encoding", "gzip")
     try:
-        with urllib.request.urlopen(req, timeout=timeout, context=ctx) as resp:
+        with urllib.request.urlopen(req, timeout=timeout, context=_SSL_CTX) as resp:
             status = resp.getcode()
-            body = resp.read()
+            body = _inflate(resp.headers, resp.read())
             return status, dict(resp.headers), body, None
     except urllib.error.HTTPError as e:
         try:
-            body = e.read()
+            body = _inflate(e.headers or {}, e.read())
         except Exception:
             body = b""
         return e.code, dict(getattr(e, "headers", {}) or {}), body, e
     except Exception as e:
         return 0, {}, b"", e
 
+def _pooled_http(method, url, headers, data, timeout):
+    # Same contract as the urllib path: errors are returned, never raised; gzip is undone by urllib3.
+    try:
+        resp = _POOL.request(
+            method, url, body=data, headers={**(headers or {}), "Accept-Encoding": "gzip"},
+            timeout=timeout, retries=_NO_RETRY,
+        )
+    except Exception as e:
+        return 0, {}, b"", e
+    resp_headers = dict(resp.headers)
+    err = None
+    if resp.status >= 400:
+        err = urllib.error.HTTPError(url, resp.status, resp.reason or "", resp.headers, None)
+    return resp.status, resp_headers, resp.data, err
+
+def _retry_after(headers: Dict[str, str]) -> Optional[float]:
+    for k, v in headers.items():
+        if k.lower() == "retry-after":
+            try:
+                return max(0.0, float(v))
+            except (TypeError, ValueError):
+                return None  # HTTP-date form; fall back to our own backoff
+    return None
+
+def _request_with_retry(
+    method: str,
+    url: str,
+    *,
+    max_attempts: int = RETRY_ATTEMPTS,
+    base: float = 0.2,
+    cap: float = 2.0,
+    retry_on: Tuple[int, ...] = RETRY_STATUSES,
+    deadline: Optional[float] = None,
+    max_retry_after: float = RETRY_AFTER_MAX,
+    **kwargs,
+) -> Tuple[int, Dict[str, str], bytes, Optional[BaseException]]:
+    """
+    _http with a few retries for transient failures (429, 5xx, transport errors).
+    Sleeps use exponential backoff with full jitter (capped at `cap`), or exactly the
+    Retry-After Simpro sends with a 429. A Retry-After above `max_retry_after`, or any
+    sleep that would run past `deadline` (a time.monotonic() value), ends the retries
+    and the last response is returned as-is. Each attempt's timeout is also cut to
+    whatever is left before `deadline`.
+    """
+    for attempt in range(max_attempts):
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return (0, {}, b"", TimeoutError("ingest budget exhausted")) if attempt == 0 else result
+            kwargs["timeout"] = min(kwargs.get("timeout", TIMEOUT), remaining)
+        result = _http(method, url, **kwargs)
+        status, headers = result[0], result[1]
+        if status not in retry_on or attempt == max_attempts - 1:
+            return result
+        delay = _retry_after(headers) if status == 429 else None
+        if delay is None:
+            delay = random.uniform(0, min(cap, base * 2 ** attempt))
+        elif delay > max_retry_after:
+            return result  # rate limited for longer than we're willing to wait
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return result
+        time.sleep(delay)
+    return result
+
 # ---- OAuth2: client_credentials ----
-def _fetch_token() -> Tuple[Optional[str], Optional[str]]:
+# Client-credentials tokens live for a while (usually an hour), so keep the last one
+# per (token_url, client_id) and only go back to Simpro when it's about to expire.
+# The in-memory cache and the optional token file share one key, _token_key().
+_TOKEN_CACHE: Dict[str, Tuple[str, float]] = {}
+_TOKEN_LOCK = threading.Lock()
+TOKEN_EXPIRY_MARGIN = 60  # seconds
+
+def _token_key() -> str:
+    return hashlib.sha256(f"{TOKEN_URL}|{CLIENT_ID}".encode()).hexdigest()
+
+def _fetch_token(deadline: Optional[float] = None) -> Tuple[Optional[str], Optional[str]]:
     if not TENANT or not CLIENT_ID or not CLIENT_SECRET:
         return None, "auth_error:missing_env (require SIMPRO_TENANT, SIMPRO_CLIENT_ID, SIMPRO_CLIENT_SECRET)"
-    token_url = f"https://{TENANT}.simprosuite.com/oauth2/token"
+    key = _token_key()
+    with _TOKEN_LOCK:
+        tok, exp = _TOKEN_CACHE.get(key) or _get_stored_token(key)
+        if tok and time.time() < exp - TOKEN_EXPIRY_MARGIN:
+            _TOKEN_CACHE[key] = (tok, exp)
+            return tok, None
+        return _request_token(TOKEN_URL, key, deadline)
+
+def _drop_token() -> None:
+    # Simpro revoked or rejected the cached token; make the next run fetch a fresh one.
+    with _TOKEN_LOCK:
+        key = _token_key()
+        _TOKEN_CACHE.pop(key, None)
+        _put_stored_token(key, None, 0.0)
+
+# With SIMPRO_TOKEN_CACHE set, the token also goes in that file (mode 0600) so a restarted
+# worker can skip the OAuth round trip while it's still valid. It is a live credential, so it
+# never goes in eod.db.
+def _read_token_file() -> Dict[str, List]:
+    try:
+        with open(TOKEN_CACHE_PATH, "rb") as f:
+            return _loads(f.read()) or {}
+    except FileNotFoundError:
+        return {}
+
+def _get_stored_token(key: str) -> Tuple[Optional[str], float]:
+    if not TOKEN_CACHE_PATH:
+        return None, 0.0
+    try:
+        tok, exp = _read_token_file().get(key) or (None, 0.0)
+        return tok, float(exp)
+    except Exception as e:
+        log.warning("[ingest] token cache read failed: %s", e)
+        return None, 0.0
+
+def _put_stored_token(key: str, token: Optional[str], expires_at: float) -> None:
+    if not TOKEN_CACHE_PATH:
+        return
+    try:
+        tokens = _read_token_file()
+        if token:
+            tokens[key] = [token, expires_at]
+        elif tokens.pop(key, None) is None:
+            return
+        tmp = f"{TOKEN_CACHE_PATH}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(tokens, f)
+        os.replace(tmp, TOKEN_CACHE_PATH)
+    except Exception as e:
+        log.warning("[ingest] token cache write failed: %s", e)
+
+def _request_token(
+    token_url: str, key: str, deadline: Optional[float] = None
+) -> Tuple[Optional[str], Optional[str]]:
     form = {
         "grant_type": "client_credentials",
         "client_id": CLIENT_ID,
@@ -65,92 +255,182 @@ def _fetch_token() -> Tuple[Optional[str], Optional[str]]:
         form["scope"] = SCOPE
     data = urllib.parse.urlencode(form).encode("utf-8")
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    status, _, body, err = _http("POST", token_url, headers=headers, data=data)
+    status, _, body, err = _request_with_retry("POST", token_url, headers=headers, data=data, deadline=deadline)
     if status != 200:
         note = f"auth_error:token_status_{status}"
         log.error("[ingest] %s", note)
         return None, note
     try:
-        payload = json.loads(body.decode("utf-8") or "{}")
-    except json.JSONDecodeError:
+        payload = _loads(body or b"{}")
+    except ValueError:  # JSONDecodeError (stdlib or orjson) and bad UTF-8
         log.error("[ingest] token response not JSON")
         return None, "auth_error:token_parse"
     token = payload.get("access_token")
     if not token:
         return None, "auth_error:no_access_token"
+    try:
+        expires_in = float(payload.get("expires_in") or 3600)
+    except (TypeError, ValueError):
+        expires_in = 3600.0
+    _TOKEN_CACHE[key] = (token, time.time() + expires_in)
+    _put_stored_token(key, *_TOKEN_CACHE[key])
     return token, None
 
 # ---- Probe for a usable endpoint ----
-def _build_probe_urls(base_url: str) -> List[str]:
+# OData-style nested guesses (company id is a guess; some tenants don't use this shape).
+# These can answer 401 even with a good token, so a 401 from them says nothing about auth.
+_GUESSED_ENTITIES = (
+    "Companies(0)/Jobs",
+    "companies(0)/jobs",
+    "Companies(1)/Jobs",
+    "companies(1)/jobs",
+    "companies/0/jobs",
+)
+
+def _is_guessed(url: str) -> bool:
+    return any(f"/{ent}?" in url for ent in _GUESSED_ENTITIES)
+
+@functools.lru_cache(maxsize=8)
+def _build_probe_urls(base_url: str) -> Tuple[str, ...]:
     """
     Build a list of 'lightweight' GETs to discover a jobs-like endpoint.
     We try a few API versions and entity names. If SIMPRO_API_BASE is set,
-    we only probe under that.
+    we only probe under that. Env is read once at import, so the result is cached.
     """
     candidates: List[str] = []
     versions = [API_BASE] if API_BASE else ["/api/v1.0", "/api/v1.1", "/api/v2.0", "/api/v2.1", "/api/v3.0"]
-    entities = [
-        "Jobs",
-        "jobs",
-        "ServiceJobs",
-        "Projects",
-        # OData-style nested guesses (company id is a guess; some tenants don't use this shape)
-        "Companies(0)/Jobs",
-        "companies(0)/jobs",
-        "Companies(1)/Jobs",
-        "companies(1)/jobs",
-        "companies/0/jobs",
-    ]
+    entities = ["Jobs", "jobs", "ServiceJobs", "Projects", *_GUESSED_ENTITIES]
     for ver in versions:
         v = ver if ver.startswith("/") else f"/{ver}"
         for ent in entities:
             # Add $top=1 to keep it light
             candidates.append(f"{base_url}{v}/{ent}?$top=1")
     # Also, if someone set API_BASE to a non-/api path, make sure we didn't double slash
-    return [u.replace("//", "/").replace("https:/", "https://") for u in candidates]
+    return tuple(u.replace("//", "/").replace("https:/", "https://") for u in candidates)
+
+# ---- Discovered endpoint cache (meta table in eod.db) ----
+# The working jobs URL is stable for a tenant, so remember it across runs instead of re-probing.
+def _discovery_key() -> str:
+    return f"jobs_endpoint:{TENANT}"
+
+# Front it with a per-process copy so repeat runs in one worker don't even touch SQLite.
+_DISCOVERED: Dict[str, Tuple[str, float]] = {}
 
-def _probe_jobs(token: str) -> Tuple[Optional[str], List[str], Optional[str]]:
+def _get_cached_probe_url() -> Optional[str]:
+    hit = _DISCOVERED.get(_discovery_key())
+    if hit and time.time() - hit[1] <= DISCOVERY_TTL:
+        return hit[0]
+    try:
+        db.init_db()
+        raw = db.get_meta(_discovery_key())
+        if not raw:
+            return None
+        stamp, url = raw.split(" ", 1)
+        if time.time() - float(stamp) > DISCOVERY_TTL:
+            return None
+        _DISCOVERED[_discovery_key()] = (url, float(stamp))
+        return url
+    except Exception as e:
+        log.warning("[ingest] discovery cache read failed: %s", e)
+        return None
+
+def _put_cached_probe_url(url: Optional[str]) -> None:
+    if url:
+        _DISCOVERED[_discovery_key()] = (url, time.time())
+    else:
+        _DISCOVERED.pop(_discovery_key(), None)
+    try:
+        db.init_db()
+        db.set_meta(_discovery_key(), f"{int(time.time())} {url}" if url else None)
+    except Exception as e:
+        log.warning("[ingest] discovery cache write failed: %s", e)
+
+def _probe_one(url: str, headers: Dict[str, str], deadline: Optional[float] = None) -> int:
+    # HEAD skips the query and the body; fall back to GET where HEAD isn't supported.
+    status, _, _, _ = _request_with_retry("HEAD", url, headers=headers, deadline=deadline)
+    if status in (405, 501):
+        status, _, _, _ = _request_with_retry("GET", url, headers=headers, deadline=deadline)
+    return status
+
+def _probe_jobs(token: str, deadline: Optional[float] = None) -> Tuple[Optional[str], List[str], Optional[str]]:
     """
     Try a handful of likely endpoints; return first that gives 200,
     plus the list of all URLs we tried (for display), and an error note if none worked.
+    Probes run in parallel; the winner is still the first 200 in declared order.
+    A previously discovered endpoint is tried alone first and only re-probed if it fails.
+    A 401 from a plain (non-guessed) path ends the search once every higher-priority
+    probe has answered without a 200, since the token itself was rejected.
+    Stops early once `deadline` (a time.monotonic() value) has passed.
     """
-    base = f"https://{TENANT}.simprosuite.com"
-    tried: List[str] = []
+    urls = _build_probe_urls(BASE_URL)
     auth_headers = {"Authorization": f"Bearer {token}", "Accept": "application/json"}
 
-    for url in _build_probe_urls(base):
-        tried.append(url)
-        status, _, body, _ = _http("GET", url, headers=auth_headers)
+    cached = _get_cached_probe_url()
+    if cached:
+        status = _probe_one(cached, auth_headers, deadline)
         if status == 200:
-            return url, tried, None
-        # 401/403 indicates token ok but permissions/feature off; still keep going
-        # 404 just means "not found here", so keep probing
-        # Any 5xx we'll also continue probing others
-    return None, tried, "probe_404:no_jobs_endpoint_found"
+            return cached, [cached], None
+        if status == 401:
+            _drop_token()  # the endpoint is fine; the token isn't
+            return None, [cached], "auth_error:probe_status_401"
+        _put_cached_probe_url(None)
+
+    statuses: Dict[str, int] = {}
+
+    def tried() -> List[str]:
+        return [u for u in urls if u in statuses]
+
+    ex = ThreadPoolExecutor(max_workers=PROBE_WORKERS)
+    try:
+        pending = {ex.submit(_probe_one, url, auth_headers, deadline): url for url in urls}
+        while pending:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                return None, tried(), "probe_timeout:budget_exhausted"
+            for fut in done:
+                statuses[pending.pop(fut)] = fut.result()
+            # 401 on a guessed path / 403 indicates token ok but permissions/feature off; still keep going
+            # 404 just means "not found here", so keep probing
+            # Any 5xx we'll also continue probing others
+            for url in urls:
+                if url not in statuses:
+                    break  # a higher-priority probe is still in flight
+                if statuses[url] == 200:
+                    _put_cached_probe_url(url)
+                    return url, tried(), None
+                if statuses[url] == 401 and not _is_guessed(url):
+                    # Nothing ranked above it worked and a real path refused the token
+                    _drop_token()
+                    return None, tried(), "auth_error:probe_status_401"
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+    return None, tried(), "probe_404:no_jobs_endpoint_found"
 
 # ---- Public entrypoint called by FastAPI ----
-def run_live_ingest() -> Dict:
+def run_live_ingest(budget_seconds: Optional[float] = None) -> Dict:
     """
     Do a tiny 'live ingest' test: obtain token, probe for a jobs-like endpoint.
     Never raises; always returns a small JSON result the UI can render.
     """
-    started = time.time()
-    run_id = int(started)  # simple stamp for logs
+    started = time.monotonic()
+    deadline = started + budget_seconds if budget_seconds else None
+    run_id = int(time.time())  # simple stamp for logs
 
     try:
-        log.info("[ingest] Starting live ingest (budget ~%ss)", TIMEOUT)
-        token, token_err = _fetch_token()
+        log.info("[ingest] Starting live ingest (budget %s)", f"{budget_seconds}s" if budget_seconds else "none")
+        token, token_err = _fetch_token(deadline)
         if token_err:
             return {
                 "ok": False,
-                "elapsed_sec": round(time.time() - started, 3),
+                "elapsed_sec": round(time.monotonic() - started, 3),
                 "jobs_inserted": 0,
                 "jobs_tried": 0,
                 "run_id": run_id,
                 "note": token_err,
             }
 
-        probe_url, tried, probe_err = _probe_jobs(token)
+        probe_url, tried, probe_err = _probe_jobs(token, deadline)
         if probe_url:
             # We found an endpoint — this is where you’d normally pull data.
             # For now we only prove connectivity.
@@ -158,7 +438,7 @@ def run_live_ingest() -> Dict:
             log.info("[ingest] %s", note)
             return {
                 "ok": True,
-                "elapsed_sec": round(time.time() - started, 3),
+                "elapsed_sec": round(time.monotonic() - started, 3),
                 "jobs_inserted": 0,
                 "jobs_tried": 1,
                 "run_id": run_id,
@@ -167,16 +447,16 @@ def run_live_ingest() -> Dict:
             }
         else:
             # Couldn’t find a usable endpoint; return what we tried so you can see it in the UI.
-            log.warning("[ingest] no jobs endpoint found; tried %s", ", ".join(tried))
+            log.warning("[ingest] no jobs endpoint found (%s); tried %s", probe_err, ", ".join(tried))
             return {
                 "ok": False,
-                "elapsed_sec": round(time.time() - started, 3),
+                "elapsed_sec": round(time.monotonic() - started, 3),
                 "jobs_inserted": 0,
                 "jobs_tried": 0,
                 "run_id": run_id,
                 "note": probe_err or "probe_failed",
                 "tried": tried,
-                "base_url": f"https://{TENANT}.simprosuite.com",
+                "base_url": BASE_URL,
             }
 
     except Exception as e:
@@ -184,7 +464,7 @@ def run_live_ingest() -> Dict:
         log.exception("ingest exception")
         return {
             "ok": False,
-            "elapsed_sec": round(time.time() - started, 3),
+            "elapsed_sec": round(time.monotonic() - started, 3),
             "jobs_inserted": 0,
             "jobs_tried": 0,
             "run_id": run_id,
@@ -9,24 +9,34 @@ def safe_div(n, d):
 def compute_metrics(rows):
   """Compute summary metrics and organize for UI."""
   totals = {
-    "hours_today": sum((r.get("hours_today") or 0) for r in rows),
-    "labour_cost_today": sum((r.get("labour_cost_today") or 0) for r in rows),
-    "materials_cost_today": sum((r.get("materials_cost_today") or 0) for r in rows),
-    "po_value_today": sum((r.get("po_value_today") or 0) for r in rows),
-    "invoiced_today": sum((r.get("invoiced_today") or 0) for r in rows),
+    "hours_today": 0,
+    "labour_cost_today": 0,
+    "materials_cost_today": 0,
+    "po_value_today": 0,
+    "invoiced_today": 0,
   }
-  mtd_cost = sum((r.get("actual_cost_to_date") or 0) for r in rows)
-  mtd_revenue = sum((r.get("revenue_invoiced_to_date") or 0) for r in rows)
+  mtd_cost = 0
+  mtd_revenue = 0
+  at_risk = []
+  exceptions = []
+  # One pass over the rows for every sum and filter.
+  for r in rows:
+    for k in totals:
+      totals[k] += r.get(k) or 0
+    mtd_cost += r.get("actual_cost_to_date") or 0
+    mtd_revenue += r.get("revenue_invoiced_to_date") or 0
+    # At-risk
+    if ((r.get("burn_pct") or 0) >= 0.80) or ((r.get("gm_to_date") or 1) < 0.20):
+      at_risk.append(r)
+    # Exceptions (idle >= 3 days)
+    if (r.get("days_since_update") or 0) >= 3:
+      exceptions.append(r)
   totals["mtd_gm_pct"] = safe_div(mtd_revenue - mtd_cost, mtd_revenue)
 
   # Top 5 by cost added today
   top5 = sorted(rows, key=lambda r: (r.get("labour_cost_today",0)+r.get("materials_cost_today",0)), reverse=True)[:5]
 
-  # At-risk
-  at_risk = [r for r in rows if ((r.get("burn_pct") or 0) >= 0.80) or ((r.get("gm_to_date") or 1) < 0.20)]
+  # At-risk, worst burn first
   at_risk = sorted(at_risk, key=lambda r: (r.get("burn_pct") or 0), reverse=True)[:5]
 
-  # Exceptions (idle >= 3 days)
-  exceptions = [r for r in rows if (r.get("days_since_update") or 0) >= 3]
-
   return totals, top5, at_risk, exceptions
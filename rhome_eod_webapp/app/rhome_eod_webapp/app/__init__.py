@@ -10,7 +10,6 @@ from __future__ import annotations
 
 import math
 from datetime import date, datetime
-from decimal import Decimal, InvalidOperation
 from typing import Any
 
 try:
@@ -26,20 +25,20 @@ except Exception:  # pragma: no cover
 def _to_number(x: Any) -> float | None:
     if x is None:
         return None
-    try:
-        # Accept Decimal, int, float, str
-        if isinstance(x, Decimal):
-            x = float(x)
-        elif isinstance(x, (int, float)):
-            x = float(x)
-        else:
-            # strings (or other) -> Decimal -> float
-            x = float(Decimal(str(x)))
-        if math.isnan(x) or math.isinf(x):
+    # Fast paths: most template values are already floats/ints from SQLite.
+    if type(x) is float:
+        n = x
+    elif type(x) is int:
+        n = float(x)
+    else:
+        try:
+            # Decimal, str (or other) -> float; float() parses numeric strings directly
+            n = float(x)
+        except (ValueError, TypeError):
             return None
-        return x
-    except (ValueError, TypeError, InvalidOperation):
+    if math.isnan(n) or math.isinf(n):
         return None
+    return n
 
 
 # ------------------------
@@ -1,37 +1,128 @@
 # app/simpro.py
 import requests
+import hashlib
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # orjson parses bytes directly and is several times faster on big job payloads
+    from orjson import loads as _loads
+except ImportError:  # pragma: no cover
+    from json import loads as _loads
+
+try:
+    import httpx  # optional HTTP/2 transport, see SIMPRO_USE_HTTP2
+except ImportError:  # pragma: no cover
+    httpx = None
 
 log = logging.getLogger("simpro")
 
+FETCH_WORKERS = int(os.getenv("SIMPRO_FETCH_WORKERS", "16"))
+POOL_SIZE = max(32, FETCH_WORKERS)  # never fewer sockets than concurrent fetches
+USE_HTTP2 = os.getenv("SIMPRO_USE_HTTP2", "").lower() in ("1", "true", "yes")
+# Set to 0 for tenants where the jobs listing is known to be disabled; skips straight to the ID scan.
+USE_LIST = os.getenv("SIMPRO_USE_LIST", "1").lower() not in ("0", "false", "no")
+
+# Errors a per-job fetch may raise with either transport.
+FETCH_ERRORS = (requests.RequestException,) + ((httpx.HTTPError,) if httpx else ())
+
+def _status_of(e) -> int:
+    """HTTP status behind a raise_for_status() error (either transport), or 0."""
+    return getattr(getattr(e, "response", None), "status_code", None) or 0
+
+def _pooled_adapter() -> HTTPAdapter:
+    retry = Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504],
+                  allowed_methods=["GET"])
+    return HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+
+def new_session() -> requests.Session:
+    """requests.Session with the pooled keep-alive adapter mounted for http and https."""
+    sess = requests.Session()
+    adapter = _pooled_adapter()
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    sess.headers.update({"Accept": "application/json", "Connection": "keep-alive"})
+    return sess
+
+def new_http2_client():
+    """
+    httpx.Client multiplexing every request over HTTP/2, or None if httpx/h2
+    aren't installed. Exposes the same get/headers/status_code/content surface
+    Client uses from a requests.Session.
+    """
+    if httpx is None:
+        return None
+    try:
+        return httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=POOL_SIZE, max_connections=POOL_SIZE * 2),
+            headers={"Accept": "application/json"},
+        )
+    except ImportError as e:  # http2=True needs the h2 package
+        log.warning("SIMPRO_USE_HTTP2 set but HTTP/2 is unavailable: %s", e)
+        return None
+
+# Shared by module-level calls (token requests) so they reuse open connections.
+_SESSION = new_session()
+
+# Access tokens last about an hour; keep them per (base_url, client_id) until
+# a minute before expiry (half their lifetime for tokens shorter than two minutes).
+# Keys are hashed so client ids aren't held as plain-text keys.
+_TOKEN_CACHE: dict = {}
+_TOKEN_LOCK = threading.Lock()
+TOKEN_EXPIRY_MARGIN = 60  # seconds
+
 def get_token(base_url: str, client_id: str, client_secret: str, timeout: int = 20) -> str:
     base = base_url.rstrip("/")
-    url = f"{base}/oauth2/token"
-    data = {
-        "grant_type": "client_credentials",
-        "client_id": client_id,
-        "client_secret": client_secret,
-    }
-    r = requests.post(url, data=data, timeout=timeout)
-    r.raise_for_status()
-    j = r.json()
-    tok = j.get("access_token", "")
-    if not tok:
-        raise RuntimeError("Simpro OAuth: no access_token in response")
-    return tok
+    key = hashlib.sha256(f"{base}|{client_id}".encode()).hexdigest()
+    with _TOKEN_LOCK:
+        tok, exp = _TOKEN_CACHE.get(key, (None, 0.0))
+        if tok and time.time() < exp:
+            return tok
+        url = f"{base}/oauth2/token"
+        data = {
+            "grant_type": "client_credentials",
+            "client_id": client_id,
+            "client_secret": client_secret,
+        }
+        r = _SESSION.post(url, data=data, timeout=timeout)
+        r.raise_for_status()
+        j = _loads(r.content)
+        tok = j.get("access_token", "")
+        if not tok:
+            raise RuntimeError("Simpro OAuth: no access_token in response")
+        expires_in = float(j.get("expires_in") or 3600)
+        _TOKEN_CACHE[key] = (tok, time.time() + expires_in - min(TOKEN_EXPIRY_MARGIN, expires_in / 2))
+        return tok
+
+class FetchRefusedError(RuntimeError):
+    """
+    Raised by get_jobs when Simpro refuses a fetch with a 4xx other than 404.
+    `status` is that code; `partial` holds the results collected before it.
+    """
+    def __init__(self, status: int, partial: dict):
+        super().__init__(f"job fetch refused with HTTP {status}")
+        self.status = status
+        self.partial = partial
 
 class Client:
     """
     Very small wrapper around the single-job endpoint that works on this tenant:
       GET /api/v1.0/companies/{companyId}/jobs/{jobId}
+    plus the paginated jobs listing, for tenants where it is enabled:
+      GET /api/v1.0/companies/{companyId}/jobs/?Stage=...&pageSize=...&page=...
     """
-    def __init__(self, base_url: str, token: str, timeout: int = 25):
+    def __init__(self, base_url: str, token: str, timeout: int = 25, session: requests.Session = None):
         self.base = base_url.rstrip("/")
-        self.sess = requests.Session()
-        self.sess.headers.update({
-            "Authorization": f"Bearer {token}",
-            "Accept": "application/json",
-        })
+        if session is None and USE_HTTP2:
+            session = new_http2_client()
+        self.sess = session or new_session()
+        self.sess.headers.update({"Authorization": f"Bearer {token}"})
         self.timeout = timeout
 
     def get_job(self, company_id: int, job_id: int):
@@ -40,4 +131,126 @@ class Client:
         if r.status_code == 404:
             return None
         r.raise_for_status()
-        return r.json()
+        return _loads(r.content)
+
+    def get_jobs(self, company_id: int, job_ids, max_workers: int = FETCH_WORKERS, deadline: float = None):
+        """
+        Fetch many jobs concurrently over the pooled session.
+        Returns {job_id: job or None}; IDs not reached before `deadline`
+        (a time.monotonic() value) are left out, as are IDs whose fetch failed
+        (including a 200 whose body isn't JSON).
+        A 4xx other than 404 (bad token, no permission) raises FetchRefusedError
+        straight away, since every other ID would be refused the same way.
+        """
+        results = {}
+        ex = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            pending = {ex.submit(self.get_job, company_id, jid): jid for jid in job_ids}
+            while pending:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                refused = None
+                for fut in done:
+                    jid = pending.pop(fut)
+                    try:
+                        results[jid] = fut.result()
+                    except FETCH_ERRORS as e:
+                        if 400 <= _status_of(e) < 500:
+                            refused = refused or e
+                        else:
+                            log.warning("get_job %s failed: %s", jid, e)
+                    except ValueError as e:  # orjson/json decode error: not a requests exception
+                        log.warning("get_job %s returned unparseable JSON: %s", jid, e)
+                if refused is not None:
+                    raise FetchRefusedError(_status_of(refused), results) from refused
+        finally:
+            # Don't block on in-flight requests once we're out of time.
+            ex.shutdown(wait=False, cancel_futures=True)
+        return results
+
+    def scan_jobs(self, company_id: int, start_id: int, end_id: int = None, stop_after_misses: int = 50,
+                  max_workers: int = FETCH_WORKERS, deadline: float = None):
+        """
+        Walk job IDs upward from `start_id`, fetching one window of
+        `stop_after_misses` IDs at a time in parallel. Stops after that many
+        consecutive 404s (or as many consecutive failed fetches), at `end_id`, at
+        `deadline`, or as soon as Simpro refuses a request with a 4xx other than
+        404 (e.g. the token expired). Returns the jobs found so far, in ID order.
+        """
+        found = []
+        misses = 0
+        errors = 0
+        jid = start_id
+        while misses < stop_after_misses and errors < stop_after_misses and (end_id is None or jid <= end_id):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            hi = jid + stop_after_misses - 1 if end_id is None else min(jid + stop_after_misses - 1, end_id)
+            window = range(jid, hi + 1)
+            refused = None
+            try:
+                results = self.get_jobs(company_id, window, max_workers=max_workers, deadline=deadline)
+            except FetchRefusedError as e:
+                refused, results = e, e.partial
+            for i in window:
+                if i not in results:
+                    errors += 1  # failed or cut off by the deadline; neither a hit nor a miss
+                    continue
+                errors = 0
+                if results[i] is None:
+                    misses += 1
+                    if misses >= stop_after_misses:
+                        break
+                else:
+                    misses = 0
+                    found.append(results[i])
+            if refused is not None:
+                log.warning("scan_jobs: %s near job %s; returning %s partial results", refused, jid, len(found))
+                break
+            jid = hi + 1
+        if errors >= stop_after_misses:
+            log.warning("scan_jobs: %s fetches in a row failed; returning %s partial results", errors, len(found))
+        return found
+
+    def list_jobs(self, company_id: int, stages=("Progress", "Pending"), page_size: int = 250, columns=None):
+        """
+        Page through the jobs listing once per stage and return every job found.
+        Returns None if the listing endpoint isn't available (404), so callers
+        can fall back to per-job lookups.
+        """
+        url = f"{self.base}/api/v1.0/companies/{int(company_id)}/jobs/"
+        jobs = []
+        for stage in stages:
+            page = 1
+            while True:
+                params = {"Stage": stage, "pageSize": page_size, "page": page}
+                if columns:
+                    params["columns"] = ",".join(columns)
+                r = self.sess.get(url, params=params, timeout=self.timeout)
+                if r.status_code == 404:
+                    return None
+                r.raise_for_status()
+                try:
+                    batch = _loads(r.content) if r.content else []
+                except ValueError as e:
+                    log.warning("jobs listing returned unparseable JSON (%s); treating it as unavailable", e)
+                    return None
+                batch = batch or []
+                jobs.extend(batch)
+                if len(batch) < page_size:
+                    break
+                page += 1
+        return jobs
+
+    def active_jobs(self, company_id: int, start_id: int = 1, stop_after_misses: int = 50, deadline: float = None):
+        """
+        Active jobs via the paginated listing (a handful of requests), falling
+        back to the per-ID scan when the listing isn't available on this tenant.
+        """
+        if USE_LIST:
+            jobs = self.list_jobs(company_id)
+            if jobs is not None:
+                return jobs
+            log.info("jobs listing unavailable; falling back to ID scan from %s", start_id)
+        return self.scan_jobs(company_id, start_id, stop_after_misses=stop_after_misses, deadline=deadline)